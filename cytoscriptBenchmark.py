@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the main CytoScript operations, run on synthetic event data
+
+Synthetic plates are written as both csv and fcs files, at each of the requested sizes, and then
+loadCSV, loadFCS, log10, calcPolygonGate, calcEllipticalGate and getSubSet are timed on them.
+The timings are saved as JSON, and can be compared against the JSON from an earlier (baseline) run, e.g.
+
+    python cytoscriptBenchmark.py --sizes 10000 100000 1000000 --out bench_new.json --baseline bench_old.json
+
+The time to import cytoscript in a fresh python process is also measured, since short lived worker processes pay it for every job,
+and --import-target sets the most that it may take, in seconds. Before timing anything, it checks that a file loaded from the file cache
+behaves the same as one parsed from the file, e.g. that it can be written into
+"""
+
+# libraries
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from cytoscript import CytoScript
+
+# the gates used by the benchmark, which are the ones used by cytoscriptTest.py
+singlet_poly_gate = [[4.4, 4.7], [4.54, 4.9], [5.3, 5.7], [5.6, 5.75], [4.7, 4.6], [4.4, 4.7]]
+FSC_H_SSC_H_elliptic_gate = {"xy": (6.25, 5.85), "width": 0.5, "height": 0.6}
+
+# the channels of the synthetic events, as (name, mean of log10, sd of log10)
+synthetic_channels = [
+    ("FSC-A", 6.3, 0.25),
+    ("FSC-H", 6.2, 0.25),
+    ("FSC-W", 5.9, 0.1),
+    ("SSC-A", 5.9, 0.3),
+    ("SSC-H", 5.8, 0.3),
+    ("BL2 PI-A", 5.1, 0.2),
+    ("BL2 PI-H", 4.9, 0.2),
+    ("R1 647-H", 5.5, 0.4),
+]
+
+
+#%% Synthetic data
+# generateEvents returns a dataframe of n_events synthetic events, whose channels are lognormal, plus a Time column
+# The A and H channels of each detector are correlated, as they are in real data, so that the singlet gate selects a realistic fraction of the events
+def generateEvents(n_events, seed=0):
+    rng = np.random.default_rng(seed)
+    size = rng.normal(0.0, 1.0, n_events)
+    data = {}
+    for name, mean, sd in synthetic_channels:
+        log_values = mean + sd * (0.8 * size + 0.6 * rng.normal(0.0, 1.0, n_events))
+        data[name] = (10 ** log_values).astype(np.float32)
+    data["Time"] = np.arange(n_events, dtype=np.float32)
+    return pd.DataFrame(data)
+
+
+# writeCSV writes the events in df to a csv file, in the form that CytoScript.loadCSV reads
+def writeCSV(fileName, df):
+    df.to_csv(fileName, index=False)
+
+
+# writeFCS writes the events in df to an FCS 3.1 file, as little endian float32 values
+# Each column name is written as both $PnN and $PnS, so the file loads with the same column names with or without column renaming
+def writeFCS(fileName, df):
+    data = np.ascontiguousarray(df.values.astype("<f4")).tobytes()
+    keywords = {
+        "$BYTEORD": "1,2,3,4",
+        "$DATATYPE": "F",
+        "$MODE": "L",
+        "$NEXTDATA": "0",
+        "$PAR": str(len(df.columns)),
+        "$TOT": str(len(df)),
+    }
+    for i, colName in enumerate(df.columns, 1):
+        keywords["$P{}N".format(i)] = colName
+        keywords["$P{}S".format(i)] = colName
+        keywords["$P{}B".format(i)] = "32"
+        keywords["$P{}E".format(i)] = "0,0"
+        keywords["$P{}R".format(i)] = "262144"
+
+    # the TEXT segment holds the offsets of the DATA segment, which depend on the length of the TEXT segment, so pad the offsets to a fixed width
+    def textSegment(data_start, data_end):
+        keywords["$BEGINDATA"] = "{:020d}".format(data_start)
+        keywords["$ENDDATA"] = "{:020d}".format(data_end)
+        keywords["$BEGINANALYSIS"] = keywords["$ENDANALYSIS"] = "0"
+        keywords["$BEGINSTEXT"] = keywords["$ENDSTEXT"] = "0"
+        return ("/" + "".join("{}/{}/".format(key, value.replace("/", "//")) for key, value in keywords.items())).encode("utf-8")
+
+    text_start = 58
+    text = textSegment(0, 0)
+    data_start = text_start + len(text)
+    data_end = data_start + len(data) - 1
+    text = textSegment(data_start, data_end)
+
+    # the HEADER offsets only have 8 digits, so files larger than that give 0 there, and rely on $BEGINDATA and $ENDDATA
+    if data_end > 99999999:
+        data_start_header, data_end_header = 0, 0
+    else:
+        data_start_header, data_end_header = data_start, data_end
+    header = "FCS3.1    {:>8}{:>8}{:>8}{:>8}{:>8}{:>8}".format(text_start, text_start + len(text) - 1, data_start_header, data_end_header, 0, 0)
+    with open(fileName, "wb") as f:
+        f.write(header.encode("ascii"))
+        f.write(text)
+        f.write(data)
+
+
+# writeSyntheticFiles writes a csv and an fcs file holding n_events synthetic events to folder, unless they are already there,
+# and returns the names of the two files
+def writeSyntheticFiles(folder, n_events, seed=0):
+    csvFileName = "synthetic_{}.csv".format(n_events)
+    fcsFileName = "synthetic_{}.fcs".format(n_events)
+    if not (os.path.exists(os.path.join(folder, csvFileName)) and os.path.exists(os.path.join(folder, fcsFileName))):
+        df = generateEvents(n_events, seed)
+        writeCSV(os.path.join(folder, csvFileName), df)
+        writeFCS(os.path.join(folder, fcsFileName), df)
+    return csvFileName, fcsFileName
+
+
+#%% Benchmarks
+# benchmarkSize times each operation on n_events synthetic events, and returns a list of {"operation", "n_events", "seconds"} records
+def benchmarkSize(folder, n_events, repeats):
+    csvFileName, fcsFileName = writeSyntheticFiles(folder, n_events)
+    cs = CytoScript()
+    cs.setWorkingDir(folder)
+    cs.addSubsetRule("numerator", "[is_singlet] & ([log10(R1 647-H)] > 5.5) & [FSC_SSC_hot_spot]")
+
+    # each step is timed on freshly loaded data, so that e.g. log10 doesn't just overwrite the columns from the previous repeat,
+    # and getSubSet doesn't just return a cached mask
+    def loaded(extra_steps):
+        def setup():
+            cs.loadCSV(csvFileName)
+            for step in extra_steps:
+                step()
+        return setup
+
+    log10 = lambda: cs.log10(removeNA=False)
+    polygon = lambda: cs.calcPolygonGate("log10(BL2 PI-H)", "log10(BL2 PI-A)", singlet_poly_gate, "is_singlet")
+    ellipse = lambda: cs.calcEllipticalGate("log10(FSC-H)", "log10(SSC-H)", FSC_H_SSC_H_elliptic_gate, "FSC_SSC_hot_spot")
+    subset = lambda: cs.getSubSet("numerator")
+
+    operations = [
+        ("loadCSV", None, lambda: cs.loadCSV(csvFileName)),
+        ("loadFCS", None, lambda: cs.loadFCS(fcsFileName)),
+        ("log10", loaded([]), log10),
+        ("calcPolygonGate", loaded([log10]), polygon),
+        ("calcEllipticalGate", loaded([log10]), ellipse),
+        ("getSubSet", loaded([log10, polygon, ellipse]), subset),
+    ]
+    records = []
+    for operation, setup, fn in operations:
+        # keep the best of the repeats
+        seconds = None
+        for i in range(repeats):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            fn()
+            elapsed = time.perf_counter() - start
+            seconds = elapsed if seconds is None else min(seconds, elapsed)
+        records.append({"operation": operation, "n_events": n_events, "seconds": seconds})
+        print("{:>20} {:>10} events: {:.4f}s".format(operation, n_events, seconds))
+    return records
+
+
+# the modules that importing cytoscript shouldn't load, since they are only needed for plotting or for the optional fcs reader
+heavy_modules = ["matplotlib", "matplotlib.pyplot", "FlowCytometryTools"]
+
+import_script = """
+import json, sys, time
+start = time.perf_counter()
+import cytoscript
+print(json.dumps({"seconds": time.perf_counter() - start, "loaded": [name for name in %r if name in sys.modules]}))
+""" % heavy_modules
+
+
+# benchmarkImport times importing cytoscript in a fresh python process, and returns an {"operation", "n_events", "seconds"} record (with n_events 0)
+# along with the list of heavy modules that the import loaded
+def benchmarkImport(repeats):
+    seconds = None
+    loaded = []
+    folder = os.path.dirname(os.path.abspath(__file__))
+    for i in range(repeats):
+        output = subprocess.run([sys.executable, "-c", import_script], cwd=folder, capture_output=True, text=True, check=True).stdout
+        result = json.loads(output)
+        seconds = result["seconds"] if seconds is None else min(seconds, result["seconds"])
+        loaded = result["loaded"]
+    print("{:>20} {:>10}       : {:.4f}s".format("import cytoscript", "", seconds))
+    return {"operation": "import cytoscript", "n_events": 0, "seconds": seconds}, loaded
+
+
+# checkFileCache loads each of the csv and fcs files twice with the file cache on, i.e. once parsed (a cache miss) and once from the cache
+# (a hit), writes into the loaded dataframe both times, and returns the names of the files for which the two loads behaved differently
+# It loads the files a third time, to check that writing into a cached dataframe didn't change the cache entry
+def checkFileCache(folder, fileNames):
+    failures = []
+    for fileName in fileNames:
+        cs = CytoScript()
+        cs.setWorkingDir(folder)
+        cs.enableFileCache(subFolderName="cytoscript_cache_check")
+        loads = []
+        for i in range(3):
+            cs.load_csv_or_fcs(fileName)
+            loads.append(cs['df'].copy())
+            try:
+                cs['df'].loc[3, "FSC-H"] = np.nan
+                loads.append(cs['df'].copy())
+            except ValueError as e:
+                loads.append(e)
+        miss, miss_written, hit, hit_written, again = loads[:5]
+        if isinstance(hit_written, Exception) or not (miss.equals(hit) and miss_written.equals(hit_written) and again.equals(miss)):
+            failures.append(fileName)
+        cs.disableFileCache()
+        shutil.rmtree(os.path.join(folder, "cytoscript_cache_check"), ignore_errors=True)
+    return failures
+
+
+# compareToBaseline returns a dataframe that sets the new timings beside the baseline timings, with the ratio new / baseline
+# Operations that got slower by more than the tolerance (e.g. 0.2 for 20%) are marked as regressions
+def compareToBaseline(records, baseline_records, tolerance=0.2):
+    new = pd.DataFrame(records).set_index(["operation", "n_events"])
+    baseline = pd.DataFrame(baseline_records).set_index(["operation", "n_events"])
+    comparison = new.join(baseline, how="left", rsuffix="_baseline")
+    comparison["ratio"] = comparison["seconds"] / comparison["seconds_baseline"]
+    comparison["regression"] = comparison["ratio"] > 1 + tolerance
+    return comparison
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time CytoScript operations on synthetic csv and fcs files")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000], help="numbers of events to benchmark, e.g. 10000 10000000")
+    parser.add_argument("--repeats", type=int, default=3, help="number of times to time each operation (the best time is kept)")
+    parser.add_argument("--dir", default=None, help="folder for the synthetic files (default: a temporary folder)")
+    parser.add_argument("--out", default="bench_results.json", help="JSON file to save the timings to")
+    parser.add_argument("--baseline", default=None, help="JSON file from an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="slowdown, as a fraction, that counts as a regression")
+    parser.add_argument("--import-target", type=float, default=None, help="most seconds that importing cytoscript may take")
+    args = parser.parse_args()
+
+    folder = args.dir if args.dir is not None else tempfile.mkdtemp(prefix="cytoscript_bench_")
+    os.makedirs(folder, exist_ok=True)
+    import_record, loaded = benchmarkImport(args.repeats)
+    records = [import_record]
+    cache_failures = checkFileCache(folder, writeSyntheticFiles(folder, min(args.sizes)))
+    for n_events in args.sizes:
+        records.extend(benchmarkSize(folder, n_events, args.repeats))
+
+    with open(args.out, "w") as f:
+        json.dump({"created": time.strftime("%Y-%m-%d %H:%M:%S"), "results": records}, f, indent=2)
+    print("saved timings to {}".format(args.out))
+
+    status = 0
+    if cache_failures:
+        print("loading {} from the file cache didn't behave like loading it from the file".format(", ".join(cache_failures)))
+        status = 1
+    if loaded:
+        print("importing cytoscript loaded {}".format(", ".join(loaded)))
+        status = 1
+    if args.import_target is not None and import_record["seconds"] > args.import_target:
+        print("importing cytoscript took {:.3f}s, more than the {:.3f}s target".format(import_record["seconds"], args.import_target))
+        status = 1
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline_records = json.load(f)["results"]
+        comparison = compareToBaseline(records, baseline_records, args.tolerance)
+        print(comparison.to_string())
+        regressions = comparison[comparison["regression"]]
+        if len(regressions):
+            print("{} operation(s) are more than {:.0%} slower than the baseline".format(len(regressions), args.tolerance))
+            status = 1
+    return status
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,6 +1,5 @@
 # import the PPK_CytoScript class from PPK_flow_cytometry_dx_api
 from cytoscript import CytoScript
-import numpy as np
 import pandas as pd
 
 #%% define a few constants that we'll use for our dx script
@@ -56,9 +55,10 @@ for file in ppkcs.workingDirFiles():
         ppkcs.addSubsetRule("numerator", "[is_singlet] & ([log10(R1 647-H)] > 5.5) & [FSC_SSC_hot_spot]")
         
         # add a row to the cumulative results for the folder ..
-        numerator = len(ppkcs.getSubSet("numerator"))
-        denominator = len(ppkcs.getSubSet("denominator"))
-        rfu = 0 if numerator < 1 else int(np.mean(ppkcs.getSubSet("numerator")['log10(R1 647-H)'].values) * 100)/100
+        stats = ppkcs.calcStatistics(["numerator", "denominator"], ["log10(R1 647-H)"], stats=["count", "mean"])
+        numerator = stats.loc["numerator", "count"]
+        denominator = stats.loc["denominator", "count"]
+        rfu = 0 if numerator < 1 else int(stats.loc["numerator", "mean(log10(R1 647-H))"] * 100)/100
             
         result_row={
                 "sample_id":ppkcs.sampleID,
@@ -1,22 +1,30 @@
 # libraries
-import matplotlib.pyplot as plt
-import matplotlib.lines as mlines
+# matplotlib is imported by the functions that use it, rather than here, so importing this module is cheap,
+# and pyplot (which sets up a GUI backend) is only imported when no axis is provided
 
 
 # drawline is used to draw a line on the current plot
 def draw_line(p1, p2, color, ax):
+    import matplotlib.lines as mlines
+
     # an axis can be provided. If it isn't, it will be created
     if ax==None:
+        import matplotlib.pyplot as plt
         ax = plt.gca()
 
     l = mlines.Line2D([p1[0],p2[0]], [p1[1],p2[1]], color=color)
     ax.add_line(l)
     return l
 
-# drawline is used to draw a line on the current plot
+# draw_lines is used to draw the line segments joining the points of poly on the current plot
+# they are drawn as a single Line2D, rather than one line per segment
 def draw_lines(poly, color, ax=None):
+    import matplotlib.lines as mlines
+
     if ax==None:
+        import matplotlib.pyplot as plt
         ax = plt.gca()
-        
-    for i in range(0,len(poly)-1):
-        draw_line(poly[i], poly[i+1], color, ax)
\ No newline at end of file
+
+    l = mlines.Line2D([p[0] for p in poly], [p[1] for p in poly], color=color)
+    ax.add_line(l)
+    return l
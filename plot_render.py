@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Has functions for rendering QC plots for many files without a display
+
+Figures are drawn with matplotlib's Agg canvas directly, rather than through pyplot, so nothing depends on
+pyplot's global state or on a GUI backend, and the same figure objects are reused from one file to the next
+"""
+
+# libraries
+import concurrent.futures
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib import patches
+from matplotlib.path import Path
+
+
+# PlotRenderer holds one reusable figure per plot name
+# get_axes returns the cleared axes for a plot, and save writes the plot to a png file
+class PlotRenderer:
+    def __init__(self, figsize=(6.4, 4.8), dpi=100):
+        self.figsize = figsize
+        self.dpi = dpi
+        self.figures = {}
+
+    # get_axes returns the axes of the named plot, with anything drawn on it for the previous file removed
+    def get_axes(self, name):
+        if name not in self.figures:
+            fig = Figure(figsize=self.figsize, dpi=self.dpi)
+            FigureCanvasAgg(fig)
+            fig.add_subplot(1, 1, 1)
+            self.figures[name] = fig
+        ax = self.figures[name].axes[0]
+        ax.cla()
+        return ax
+
+    # save renders the named plot and writes it to a png file
+    def save(self, name, fileName):
+        self.figures[name].savefig(fileName, dpi=self.dpi)
+
+    # axes_pixels returns the size of the axes of the named plot, in pixels
+    def axes_pixels(self, name):
+        bbox = self.figures[name].axes[0].get_window_extent()
+        return max(int(bbox.width), 1), max(int(bbox.height), 1)
+
+
+# pixel_downsample returns the indices of a subset of the x, y points that has (at most) one point per pixel of a width x height pixel grid over
+# xlim x ylim, and drops the points outside of it. Plotting the subset with 1 pixel markers looks the same as plotting all of the points,
+# but a million point scatter shrinks to at most width * height points
+def pixel_downsample(x, y, xlim, ylim, width, height):
+    x = np.asarray(x)
+    y = np.asarray(y)
+    with np.errstate(invalid="ignore"):
+        visible = np.flatnonzero((x >= xlim[0]) & (x <= xlim[1]) & (y >= ylim[0]) & (y <= ylim[1]))
+    px = ((x[visible] - xlim[0]) * ((width - 1) / (xlim[1] - xlim[0]))).astype(np.intp)
+    py = ((y[visible] - ylim[0]) * ((height - 1) / (ylim[1] - ylim[0]))).astype(np.intp)
+    _, first = np.unique(px * height + py, return_index=True)
+    return visible[np.sort(first)]
+
+
+# scatter draws a scatter plot of x vs y on ax, using the axes limits xlim and ylim
+# If there are more than max_points points, they are pixel downsampled first, and the markers are always rasterized,
+# so the cost of drawing and saving the plot doesn't grow with the number of events
+def scatter(ax, x, y, color, xlim, ylim, s=1, max_points=20000):
+    ax.set_xlim(xlim)
+    ax.set_ylim(ylim)
+    if len(x) > max_points:
+        bbox = ax.get_window_extent()
+        keep = pixel_downsample(x, y, xlim, ylim, max(int(bbox.width), 1), max(int(bbox.height), 1))
+        x = np.asarray(x)[keep]
+        y = np.asarray(y)[keep]
+    return ax.scatter(x, y, color=color, s=s, rasterized=True, linewidths=0)
+
+
+# draw_polygon draws the outline of a polygon gate on ax as a single path artist (rather than one line per edge)
+# The outline is always closed, as CytoScript.applyPolygonGate always joins the last vertex back to the first
+def draw_polygon(ax, poly, color, linewidth=1):
+    vertices = np.asarray(poly, dtype=float)
+    path = Path(np.vstack((vertices, vertices[:1])), closed=True)
+    patch = patches.PathPatch(path, edgecolor=color, facecolor="none", linewidth=linewidth, zorder=2)
+    ax.add_patch(patch)
+    return patch
+
+
+# draw_ellipse draws the outline of an elliptical gate on ax. The ellipse has the same form as for CytoScript.applyEllipticalGate
+def draw_ellipse(ax, ellipse, color, linewidth=1):
+    center = ellipse['xy'] if 'xy' in ellipse else ellipse['center']
+    patch = patches.Ellipse(xy=center, width=ellipse['width'], height=ellipse['height'], angle=ellipse.get('angle', 0.0),
+                            edgecolor=color, facecolor="none", linewidth=linewidth, zorder=2)
+    ax.add_patch(patch)
+    return patch
+
+
+# histogram draws precomputed histogram counts (e.g. from CytoScript.calcHistogram) with bin edges edges on ax, without recalculating them
+def histogram(ax, counts, edges, color):
+    return ax.stairs(counts, edges, color=color, fill=True)
+
+
+# histogram2d draws precomputed 2d histogram counts (e.g. from CytoScript.calcHistogram2D) over range [[xmin, xmax], [ymin, ymax]] on ax
+def histogram2d(ax, counts, range, cmap="coolwarm"):
+    return ax.imshow(np.asarray(counts).T, origin="lower", aspect="auto", cmap=cmap, interpolation="nearest",
+                     extent=(range[0][0], range[0][1], range[1][0], range[1][1]))
+
+
+# each worker process keeps one PlotRenderer, so its figures are reused for all of the items that the worker renders
+worker_renderer = None
+
+
+def render_item(render_fn, item, figsize, dpi):
+    global worker_renderer
+    if worker_renderer is None:
+        worker_renderer = PlotRenderer(figsize, dpi)
+    return render_fn(worker_renderer, item)
+
+
+# render_all calls render_fn(renderer, item) for each item, in a pool of worker processes, and returns the results in the same order as items
+# render_fn should draw its plots with the renderer's get_axes, and write them with its save function. It must be picklable,
+# i.e. defined at the top level of a module, and so must the items. If workers is 1, the items are rendered in this process
+def render_all(render_fn, items, workers=None, figsize=(6.4, 4.8), dpi=100):
+    if workers == 1:
+        renderer = PlotRenderer(figsize, dpi)
+        return [render_fn(renderer, item) for item in items]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(render_item, render_fn, item, figsize, dpi) for item in items]
+        return [future.result() for future in futures]